@@ -1,10 +1,18 @@
-import json, os, requests, asyncio, aiohttp
-from flask import Flask, request, jsonify
+import json, os, re, requests, asyncio, aiohttp, atexit, hashlib, tempfile, threading
+import requests.adapters
+from upstream_cache import SharedGeneration, UpstreamCache
+from country_index import CountryIndex
+from json_stream import aiter_json_array, iter_json_array, iter_json_array_text, iter_json_columns_text
+from payload import gzip_stream, json_payload_response, parse_fields, project, shape_rows
+from snapshot import SnapshotStore
+from clusters import MAX_ZOOM, ClusterIndex, cell_size, parse_bbox
+from sqlalchemy.exc import SQLAlchemyError
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 
 ### Set up the API URLs ###
 
-malaria_base_url = 'http://3.91.201.73:7071/api'  # TODO: change to AWS API Gateway URL after deloyment
+malaria_base_url = os.environ.get('MALARIA_BASE_URL', 'http://3.91.201.73:7071/api')  # TODO: change to AWS API Gateway URL after deloyment
 malaria_endpoints = {
     'reset': '/reset/malaria',      # PUT
     'filter': '/malaria/filter',    # support ?region=&year=&who_region=&iso=&page=&per_page= query parameters
@@ -14,7 +22,7 @@ malaria_endpoints = {
     '<id>': '/malaria/<id>'
 }
 
-country_base_url = 'http://52.12.107.239:7070/api'  # TODO: change to AWS API Gateway URL after deloyment
+country_base_url = os.environ.get('COUNTRY_BASE_URL', 'http://52.12.107.239:7070/api')  # TODO: change to AWS API Gateway URL after deloyment
 country_endpoints = {
     'reset': '/reset/country',      # PUT
     'get': '/country',              # support ?iso= query parameter
@@ -27,27 +35,259 @@ API_URLS = {
     'country': {endpoint: country_base_url + path for endpoint, path in country_endpoints.items()}
 }
 
-def make_api_request(url, method, **kwargs):
+### Upstream transport ###
+# One pool of keep-alive connections and one event loop per gunicorn worker.
+# Everything is created lazily, so each forked worker builds its own.
+
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 10))       # connections kept per service
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+# Some WSGI routes make two upstream calls one after the other, and both must fit under gunicorn's
+# -t 30: 2 * (3.05 + 10) s. The read timeout is per socket read, so a body that keeps trickling in
+# can still take longer.
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 10))
+UPSTREAM_KEEPALIVE = float(os.environ.get('UPSTREAM_KEEPALIVE', 30))     # seconds an idle async connection is kept
+UPSTREAM_CONCURRENCY = int(os.environ.get('UPSTREAM_CONCURRENCY', 100))  # in-flight async upstream calls per worker
+
+_transport = {'pid': None, 'session': None, 'loop': None, 'thread': None, 'async_session': None, 'slots': None}
+_transport_lock = threading.Lock()
+
+def _reset_transport_after_fork():
+    if _transport['pid'] != os.getpid():
+        _transport.update(pid=os.getpid(), session=None, loop=None, thread=None, async_session=None, slots=None)
+
+def get_session():
+    with _transport_lock:
+        _reset_transport_after_fork()
+        if _transport['session'] is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=len(API_URLS), pool_maxsize=UPSTREAM_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _transport['session'] = session
+        return _transport['session']
+
+def get_worker_loop():
+    with _transport_lock:
+        _reset_transport_after_fork()
+        if _transport['loop'] is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name='upstream-loop', daemon=True)
+            thread.start()
+            _transport.update(loop=loop, thread=thread)
+        return _transport['loop']
+
+def get_async_session():
+    # Must be called from the loop that owns the session: the worker loop under WSGI,
+    # or the server's loop under ASGI
+    if _transport['async_session'] is None or _transport['async_session'].closed:
+        connector = aiohttp.TCPConnector(
+            limit=UPSTREAM_POOL_SIZE * len(API_URLS),
+            limit_per_host=UPSTREAM_POOL_SIZE,
+            keepalive_timeout=UPSTREAM_KEEPALIVE)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=UPSTREAM_CONNECT_TIMEOUT, sock_read=UPSTREAM_READ_TIMEOUT)
+        _transport['async_session'] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _transport['slots'] = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+    return _transport['async_session']
+
+def get_upstream_slots():
+    get_async_session()
+    return _transport['slots']
+
+async def close_async_transport():
+    # For the ASGI server, whose loop owns the session and outlives no request
+    async_session = _transport['async_session']
+    _transport.update(async_session=None, slots=None)
+    if async_session is not None:
+        await async_session.close()
+
+def run_in_worker_loop(coroutine):
+    future = asyncio.run_coroutine_threadsafe(coroutine, get_worker_loop())
+    return future.result()
+
+@atexit.register
+def close_transport():
+    with _transport_lock:
+        if _transport['pid'] != os.getpid():
+            return
+        session, loop, thread = _transport['session'], _transport['loop'], _transport['thread']
+        async_session = _transport['async_session']
+        _transport.update(session=None, loop=None, thread=None, async_session=None, slots=None)
+
+    if session is not None:
+        session.close()
+    if loop is not None:
+        if async_session is not None:
+            asyncio.run_coroutine_threadsafe(async_session.close(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        loop.close()
+
+### Upstream response cache ###
+# GET responses for the endpoints below are cached per worker. A TTL of 0 disables caching.
+
+CACHE_TTLS = {
+    ('country', 'get'): int(os.environ.get('CACHE_TTL_COUNTRY', 600)),    # reference data, rarely changes
+    ('malaria', 'filter'): int(os.environ.get('CACHE_TTL_MALARIA', 300)),
+    ('malaria', 'all'): int(os.environ.get('CACHE_TTL_MALARIA', 300)),
+    ('malaria', 'iso'): int(os.environ.get('CACHE_TTL_MALARIA', 300))
+}
+
+upstream_cache = UpstreamCache(max_bytes=int(os.environ.get('CACHE_MAX_BYTES', 32 * 1024 * 1024)))
+
+# Resets are shared with the other workers of this container through one file per service.
+# Workers of other containers only catch up when their entries expire.
+CACHE_SIGNAL_DIR = os.environ.get('CACHE_SIGNAL_DIR', tempfile.gettempdir())
+for _service, _base_url in (('malaria', malaria_base_url), ('country', country_base_url)):
+    _signal_name = f'visualization-{_service}-{hashlib.sha1(_base_url.encode()).hexdigest()[:12]}.gen'
+    upstream_cache.watch(_base_url, SharedGeneration(os.path.join(CACHE_SIGNAL_DIR, _signal_name)))
+
+def cache_ttl(url):
+    for (service, endpoint), ttl in CACHE_TTLS.items():
+        if API_URLS[service][endpoint] == url:
+            return ttl
+    return 0
+
+def invalidate_cache(service):
+    base_url = {'malaria': malaria_base_url, 'country': country_base_url}[service]
+    upstream_cache.invalidate(base_url)
+
+def _request_upstream(url, method, **kwargs):
+    """Return (response_data, size, ok) for one upstream call."""
+    kwargs.setdefault('timeout', (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
     try:
-        response = requests.request(method, url, **kwargs)
+        response = get_session().request(method, url, **kwargs)
 
         if response.status_code == 200:
             if response.headers['Content-Type'] == 'application/json':
                 response_data = response.json()  # Parse JSON response
             else:
                 response_data = response.text  # Get response as a string
-            return jsonify(response_data)
+            return response_data, len(response.content), True
         else:
-            return jsonify({
+            return {
                 'error': f'Status: {response.status_code} {response.text}'
-                })
+                }, 0, False
     except requests.RequestException as e:
-        return jsonify({'error': f'Error making API request: {str(e)}'})
+        return {'error': f'Error making API request: {str(e)}'}, 0, False
+
+def fetch_api_data(url, method, **kwargs):
+    """Like make_api_request, but returns the parsed data. Cached data is shared, so do not mutate it."""
+    ttl = cache_ttl(url) if method == 'GET' else 0
+    if ttl <= 0:
+        response_data, _, _ = _request_upstream(url, method, **kwargs)
+        return response_data
+
+    key = upstream_cache.make_key(url, kwargs.get('params'))
+    return upstream_cache.get_or_fetch(
+        key, ttl, lambda: _request_upstream(url, method, **kwargs))
+
+def make_api_request(url, method, **kwargs):
+    return jsonify(fetch_api_data(url, method, **kwargs))
+
+def open_api_stream(url, method='GET', **kwargs):
+    """Return (response, None) with the body left unread, or (None, error) like make_api_request."""
+    kwargs.setdefault('timeout', (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT))
+    try:
+        response = get_session().request(method, url, stream=True, **kwargs)
+    except requests.RequestException as e:
+        return None, {'error': f'Error making API request: {str(e)}'}
+
+    if response.status_code != 200 or response.headers.get('Content-Type') != 'application/json':
+        error = {'error': f'Status: {response.status_code} {response.text}'}
+        response.close()
+        return None, error
+    return response, None
+
+def iter_api_rows(response, chunk_size=64 * 1024):
+    """Yield the rows of a streamed upstream JSON array, closing the response when done."""
+    try:
+        yield from iter_json_array(response.iter_content(chunk_size))
+    finally:
+        response.close()
+
+async def _async_request_upstream(url, method, params=None):
+    """Async version of _request_upstream."""
+    # requests drops None params, aiohttp rejects them
+    params = {key: value for key, value in (params or {}).items() if value is not None}
+    try:
+        async with get_upstream_slots():
+            async with get_async_session().request(method, url, params=params) as response:
+                body = await response.read()
+
+                if response.status == 200:
+                    if response.headers.get('Content-Type') == 'application/json':
+                        response_data = json.loads(body)
+                    else:
+                        response_data = body.decode(response.get_encoding())
+                    return response_data, len(body), True
+                else:
+                    return {
+                        'error': f'Status: {response.status} {body.decode(errors="replace")}'
+                        }, 0, False
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return {'error': f'Error making API request: {str(e)}'}, 0, False
+
+async def async_fetch_api_data(url, method, params=None):
+    """Async version of fetch_api_data, sharing its cache."""
+    ttl = cache_ttl(url) if method == 'GET' else 0
+    if ttl <= 0:
+        response_data, _, _ = await _async_request_upstream(url, method, params=params)
+        return response_data
+
+    key = upstream_cache.make_key(url, params)
+    return await upstream_cache.get_or_fetch_async(
+        key, ttl, lambda: _async_request_upstream(url, method, params=params))
+
+class AsyncApiStream:
+    """An open upstream response, holding one of the upstream slots until it is released."""
+
+    def __init__(self, response, slots):
+        self.response = response
+        self._slots = slots
+
+    def release(self):
+        if self._slots is not None:
+            self.response.release()
+            self._slots.release()
+            self._slots = None
+
+async def open_async_api_stream(url, method='GET'):
+    """Async version of open_api_stream, returning an AsyncApiStream for aiter_api_rows."""
+    slots = get_upstream_slots()
+    await slots.acquire()
+    try:
+        response = await get_async_session().request(method, url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        slots.release()
+        return None, {'error': f'Error making API request: {str(e)}'}
+    except BaseException:
+        slots.release()
+        raise
+
+    stream = AsyncApiStream(response, slots)
+    if response.status != 200 or response.headers.get('Content-Type') != 'application/json':
+        try:
+            error = {'error': f'Status: {response.status} {await response.text()}'}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = {'error': f'Error making API request: {str(e)}'}
+        finally:
+            stream.release()
+        return None, error
+    return stream, None
+
+async def aiter_api_rows(stream, chunk_size=64 * 1024):
+    """Async version of iter_api_rows, releasing the stream and its slot when done."""
+    try:
+        async for row in aiter_json_array(stream.response.content.iter_chunked(chunk_size)):
+            yield row
+    finally:
+        stream.release()
 
 async def async_make_api_request(url, method, params=None, session=None):
     if session is None:
-        async with aiohttp.ClientSession() as session:
-            return await async_make_api_request(url, method, params=params, session=session)
+        session = get_async_session()
 
     methods = {
         'GET': session.get,
@@ -57,26 +297,212 @@ async def async_make_api_request(url, method, params=None, session=None):
     }
 
     if method in methods:
-        async with methods[method](url, params=params) as response:
-            return await response.json()
+        async with get_upstream_slots():
+            async with methods[method](url, params=params) as response:
+                return await response.json()
     else:
         raise ValueError(f'Invalid method: {method}')
 
 async def fetch_data(urls, method, params=None):    # Assume all URLs use the same method
-    async with aiohttp.ClientSession() as session:
-        tasks = [
-            async_make_api_request(url, method, params=params, session=session) for url in urls
-        ]
-        responses = []
-        for future in asyncio.as_completed(tasks):
-            response = await future
-            responses.append(response)
-        return responses
-
-def run_in_new_loop(coroutine):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    return loop.run_until_complete(coroutine)
+    session = get_async_session()
+    tasks = [
+        async_make_api_request(url, method, params=params, session=session) for url in urls
+    ]
+    responses = []
+    for future in asyncio.as_completed(tasks):
+        response = await future
+        responses.append(response)
+    return responses
+
+### Country index used to enrich malaria rows ###
+
+country_index = CountryIndex()
+
+def _country_source(iso=None):
+    # With an ISO filter only the matching countries are fetched and merged into the index
+    if iso:
+        return {'iso': iso}, f'iso={iso}', False
+    return None, 'all', True
+
+def load_country_index(iso=None):
+    params, source, complete = _country_source(iso)
+    countries = fetch_api_data(API_URLS['country']['get'], 'GET', params=params)
+    country_index.update(countries, source=source, complete=complete)
+
+async def async_load_country_index(iso=None):
+    params, source, complete = _country_source(iso)
+    countries = await async_fetch_api_data(API_URLS['country']['get'], 'GET', params=params)
+    country_index.update(countries, source=source, complete=complete)
+
+### Local snapshot of the joined dataset, used by /api/malaria/filter when enabled ###
+
+SNAPSHOT_MODE = os.environ.get('SNAPSHOT_MODE', '').lower() in ('1', 'true', 'yes')
+
+def load_snapshot_rows():
+    malaria_data = fetch_api_data(API_URLS['malaria']['all'], 'GET')
+    if not isinstance(malaria_data, list):
+        return None
+    # Without the countries every row would be unmatched, so keep the previous snapshot and retry
+    countries = fetch_api_data(API_URLS['country']['get'], 'GET')
+    if not isinstance(countries, list):
+        return None
+    country_index.update(countries)
+    rows, unmatched = country_index.join(malaria_data)
+    return malaria_data, rows, unmatched
+
+snapshot_store = SnapshotStore(
+    load_snapshot_rows, refresh_seconds=int(os.environ.get('SNAPSHOT_REFRESH_SECONDS', 900)))
+
+### Batch lookups for /api/malaria_country/batch ###
+
+BATCH_MAX_KEYS = int(os.environ.get('BATCH_MAX_KEYS', 100))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 8))     # upstream calls in flight per batch
+# ISO codes per upstream ?iso= query. 1 looks each code up on its own /iso/<iso> endpoints; set it
+# higher only for upstreams known to accept comma-separated ?iso= values.
+BATCH_ISO_CHUNK = int(os.environ.get('BATCH_ISO_CHUNK', 1))
+BATCH_PAGE_SIZE = 500       # rows per upstream /malaria/filter page
+INTEGER = re.compile(r'^-?[0-9]+$')
+ISO_CODE = re.compile(r'^[A-Z]{2,3}$')      # codes go into upstream URL paths, so nothing else is let through
+
+def batch_keys(body, args):
+    """Return (kind, keys, error) from a batch request's JSON body or query args.
+
+    kind is 'ids' or 'iso'. Keys are deduplicated, keeping the order they were given in.
+    """
+    values = {}
+    for kind in ('ids', 'iso'):
+        value = body.get(kind) if isinstance(body, dict) else args.get(kind)
+        if isinstance(value, str):
+            value = value.split(',')
+        if value:
+            values[kind] = value
+    if len(values) != 1:
+        return None, None, 'Provide either ids or iso'
+
+    kind, keys = values.popitem()
+    if not isinstance(keys, list):
+        return None, None, f'{kind} must be a list'
+    if kind == 'ids':
+        # JSON true/false are ints to Python, and would call /malaria/True and dedupe with 1
+        if any(isinstance(key, bool) or not isinstance(key, (int, str)) for key in keys):
+            return None, None, 'ids must be integers or strings'
+        keys = [key.strip() if isinstance(key, str) else key for key in keys]
+        keys = [int(key) if isinstance(key, str) and INTEGER.match(key) else key for key in keys if key != '']
+    else:
+        keys = [key.strip().upper() if isinstance(key, str) else key for key in keys]
+        keys = [key for key in keys if key != '']
+        invalid = next((key for key in keys if not isinstance(key, str) or not ISO_CODE.match(key)), None)
+        if invalid is not None:
+            return None, None, f'Invalid ISO code: {invalid!r}'
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return None, None, f'No {kind} given'
+    if len(keys) > BATCH_MAX_KEYS:
+        return None, None, f'At most {BATCH_MAX_KEYS} keys per batch'
+    return kind, keys, None
+
+async def _batch_by_id(id, slots):
+    if not isinstance(id, int) or isinstance(id, bool):
+        return {'id': id, 'error': f'Invalid id: {id}'}
+
+    malaria_url = API_URLS['malaria']['<id>'].replace('<id>', str(id))
+    country_url = API_URLS['country']['<id>'].replace('<id>', str(id))
+    async with slots:
+        (malaria, _, malaria_ok), (country, _, country_ok) = await asyncio.gather(
+            _async_request_upstream(malaria_url, 'GET'),
+            _async_request_upstream(country_url, 'GET'))
+
+    item = {'id': id, 'malaria': malaria if malaria_ok else None, 'country': country if country_ok else None}
+    errors = [response['error'] for response, ok in ((malaria, malaria_ok), (country, country_ok)) if not ok]
+    if errors:
+        item['error'] = '; '.join(errors)
+    return item
+
+async def _fetch_all_filter_pages(iso):
+    params = {'iso': iso, 'page': 1, 'per_page': BATCH_PAGE_SIZE}
+    malaria_data = await async_fetch_api_data(API_URLS['malaria']['filter'], 'GET', params=params)
+    if 'malaria_data' not in malaria_data:
+        return malaria_data
+
+    total_pages = malaria_data.get('total_pages')
+    if total_pages is None and 'total_items' in malaria_data:
+        total_pages = -(-malaria_data['total_items'] // BATCH_PAGE_SIZE)
+    if total_pages is None:
+        return {'error': 'Upstream filter response has no total_pages or total_items'}
+
+    pages = await asyncio.gather(*(
+        async_fetch_api_data(API_URLS['malaria']['filter'], 'GET', params={**params, 'page': page})
+        for page in range(2, total_pages + 1)))
+    rows = list(malaria_data['malaria_data'])
+    for page in pages:
+        if 'malaria_data' not in page:
+            return page
+        rows.extend(page['malaria_data'])
+    return rows
+
+async def _fetch_iso_chunk(chunk):
+    """Return (malaria_rows, countries) for a chunk of ISO codes, or an error dict in place of either."""
+    if len(chunk) > 1:
+        iso = ','.join(chunk)
+        return await asyncio.gather(
+            _fetch_all_filter_pages(iso),
+            async_fetch_api_data(API_URLS['country']['get'], 'GET', params={'iso': iso}))
+
+    iso = chunk[0]
+    malaria_url = API_URLS['malaria']['iso/<iso>'].replace('<iso>', iso)
+    country_url = API_URLS['country']['iso/<iso>'].replace('<iso>', iso)
+    (malaria, _, malaria_ok), (country, _, country_ok) = await asyncio.gather(
+        _async_request_upstream(malaria_url, 'GET'),
+        _async_request_upstream(country_url, 'GET'))
+    # A code the service does not know is a miss, not a failure of the whole lookup
+    if not malaria_ok and malaria['error'].startswith('Status: 404'):
+        malaria, malaria_ok = [], True
+    if not country_ok and country['error'].startswith('Status: 404'):
+        country, country_ok = [], True
+    if country_ok:
+        country = [country] if isinstance(country, dict) else country or []
+    return malaria, country
+
+async def _batch_by_iso(isos, slots):
+    # With BATCH_ISO_CHUNK > 1, one filter query and one country query per chunk of ISO codes
+    chunks = [isos[i:i + BATCH_ISO_CHUNK] for i in range(0, len(isos), max(BATCH_ISO_CHUNK, 1))]
+
+    async def fetch_chunk(chunk):
+        async with slots:
+            return await _fetch_iso_chunk(chunk)
+
+    items = {iso: {'iso': iso, 'malaria': [], 'country': None} for iso in isos}
+    errors = {iso: [] for iso in isos}
+    for chunk, responses in zip(chunks, await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks))):
+        malaria_rows, countries = responses
+        for field, response in (('malaria', malaria_rows), ('country', countries)):
+            if not isinstance(response, list):
+                error = response.get('error') if isinstance(response, dict) else None
+                for iso in chunk:
+                    errors[iso].append(error or f'Unexpected {field} response')
+                continue
+            for record in response:
+                item = items.get(record.get('iso'))
+                if item is None:
+                    continue
+                if field == 'malaria':
+                    item['malaria'].append(record)
+                else:
+                    item['country'] = record
+
+    for iso, item in items.items():
+        if errors[iso]:
+            item['error'] = '; '.join(errors[iso])
+        elif not item['malaria'] and item['country'] is None:
+            item['error'] = f'No malaria or country data for ISO {iso}'
+    return list(items.values())
+
+async def fetch_malaria_country_batch(kind, keys):
+    """Return one item per key, in input order, each with malaria and country data or an error."""
+    slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+    if kind == 'ids':
+        return list(await asyncio.gather(*(_batch_by_id(id, slots) for id in keys)))
+    return await _batch_by_iso(keys, slots)
 
 ### Set up the app ###
 
@@ -84,6 +510,10 @@ app = Flask(__name__)
 app.json.sort_keys = False
 CORS(app)
 
+if SNAPSHOT_MODE:
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SNAPSHOT_DATABASE_URI', 'sqlite:///snapshot.db')
+    snapshot_store.init_app(app)
+
 # NOTE: This route is needed for the default EB health check route
 @app.route('/')  
 def home():
@@ -91,22 +521,36 @@ def home():
 
 ### Reset databases - Not to be consumed by frontend ###
 
+def after_reset(*services):
+    # Run after the upstream reset, so nothing fetched mid-reset survives
+    for service in services:
+        invalidate_cache(service)
+    if 'country' in services:
+        country_index.clear()
+    if SNAPSHOT_MODE:
+        snapshot_store.request_rebuild()
+
 @app.route('/api/reset/malaria/', methods=['PUT'])
 def reset_malaria_db():
-    return make_api_request(API_URLS['malaria']['reset'], 'PUT')
+    response = make_api_request(API_URLS['malaria']['reset'], 'PUT')
+    after_reset('malaria')
+    return response
 
 @app.route('/api/reset/country/', methods=['PUT'])
 def reset_country_db():
-    return make_api_request(API_URLS['country']['reset'], 'PUT')
+    response = make_api_request(API_URLS['country']['reset'], 'PUT')
+    after_reset('country')
+    return response
 
 @app.route('/api/reset/', methods=['PUT'])
 def reset_all_dbs():
-    malaria_response = make_api_request(API_URLS['malaria']['reset'], 'PUT')
-    country_response = make_api_request(API_URLS['country']['reset'], 'PUT')
+    malaria_response = fetch_api_data(API_URLS['malaria']['reset'], 'PUT')
+    country_response = fetch_api_data(API_URLS['country']['reset'], 'PUT')
+    after_reset('malaria', 'country')
 
     return jsonify({
-        'malaria': malaria_response.json,
-        'country': country_response.json
+        'malaria': malaria_response,
+        'country': country_response
     })
 
 ### Country and Malaria resources ###
@@ -116,43 +560,170 @@ def get_country():
     params = {'iso': request.args.get('iso')}
     return make_api_request(API_URLS['country']['get'], 'GET', params=params)
 
+# Helpers shared with the ASGI app in asgi.py
+
+def dump_json(data):
+    return app.json.dumps(data, separators=(',', ':'))
+
+def filter_params(args):
+    return {
+        'region': args.get('region'),
+        'year': args.get('year'),
+        'who_region': args.get('who_region'),
+        'page': args.get('page', 1, type=int),
+        'per_page': args.get('per_page', 10, type=int),
+        'iso': args.get('iso')
+    }
+
+def payload_args(args):
+    """Read the fields= projection and format= layout shared by the malaria data routes."""
+    fields = parse_fields(args.get('fields'))
+    fmt = args.get('format', 'rows')
+    if fmt not in ('rows', 'columns'):
+        return None, None, f'Invalid format: {fmt}'
+    return fields, fmt, None
+
+def query_snapshot(params):
+    """Return the snapshot's answer to a filter query, or None to use the live services."""
+    if not SNAPSHOT_MODE:
+        return None
+    try:
+        return snapshot_store.query(**params)
+    except SQLAlchemyError:
+        app.logger.exception('Snapshot query failed, falling back to the live services')
+        return None
+
+def snapshot_response(snapshot_data, fields, fmt, request, response_class):
+    """Return a page of snapshot results, with the snapshot's age in a header.
+
+    The age changes on every request, so keeping it out of the body keeps the ETag stable
+    until the snapshot itself changes.
+    """
+    meta = dict(snapshot_data['snapshot'])
+    age_seconds = meta.pop('age_seconds')
+    body = dump_json({
+        **snapshot_data,
+        'malaria_data': shape_rows(snapshot_data['malaria_data'], fields, fmt),
+        'snapshot': meta
+    }).encode()
+    response = json_payload_response(body, request, response_class)
+    response.headers['X-Snapshot-Version'] = str(meta['version'])
+    response.headers['X-Snapshot-Age'] = str(age_seconds)
+    return response
+
+def filter_body(malaria_data, fields, fmt):
+    """Return (body, unmatched) for a page of upstream filter results, once the country index is loaded."""
+    rows, unmatched = country_index.join(malaria_data['malaria_data'])
+    return dump_json({**malaria_data, 'malaria_data': shape_rows(rows, fields, fmt)}).encode(), unmatched
+
+def enrich_row(malaria, fields, counts):
+    row, matched = country_index.join_row(malaria)
+    counts['unmatched'] += not matched
+    return project(row, fields)
+
+def log_unmatched(counts):
+    if counts['unmatched']:
+        app.logger.info('%d malaria rows had no matching country', counts['unmatched'])
+
+cluster_index = ClusterIndex()
+
+def cluster_args(args):
+    """Return (bbox, zoom, years, error) for /api/malaria/clusters."""
+    bbox = parse_bbox(args.get('bbox', '-180,-90,180,90'))
+    if bbox is None:
+        return None, None, None, 'bbox must be west,south,east,north in degrees'
+    zoom = args.get('zoom', '0').strip()
+    if not (zoom.isascii() and zoom.isdigit()) or not 0 <= int(zoom) <= MAX_ZOOM:
+        return None, None, None, f'zoom must be an integer from 0 to {MAX_ZOOM}'
+    zoom = int(zoom)
+    years = [year.strip() for year in args.get('year', '').split(',') if year.strip()] or None
+    return bbox, zoom, years, None
+
+def clusters_body(malaria_data, bbox, zoom, years):
+    """Return the clusters for a viewport, once the country index is loaded."""
+    cluster_index.ensure(
+        malaria_data, country_index.version,
+        (country_index.join_row(malaria)[0] for malaria in malaria_data))
+    clusters = cluster_index.clusters(bbox, zoom, years)
+    return dump_json({
+        'zoom': zoom,
+        'cell_size': cell_size(zoom),
+        'count': sum(cluster['count'] for cluster in clusters),
+        'clusters': clusters
+    }).encode()
+
 @app.route('/api/malaria/filter')
 def filter_malaria():
-    params = {
-        'region': request.args.get('region'),
-        'year': request.args.get('year'),
-        'who_region': request.args.get('who_region'),
-        'page': request.args.get('page', 1, type=int),
-        'per_page': request.args.get('per_page', 10, type=int),
-        'iso': request.args.get('iso')
-    }
+    params = filter_params(request.args)
+    fields, fmt, error = payload_args(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+
+    snapshot_data = query_snapshot(params)
+    if snapshot_data is not None:
+        return snapshot_response(snapshot_data, fields, fmt, request, Response)
 
-    malaria_data = make_api_request(
-        API_URLS['malaria']['filter'], 'GET', params=params).json
-    country_data = make_api_request(
-        API_URLS['country']['get'], 'GET', params={'iso': params['iso']}).json
+    malaria_data = fetch_api_data(API_URLS['malaria']['filter'], 'GET', params=params)
+    if 'malaria_data' not in malaria_data:
+        return jsonify(malaria_data)
 
-    for malaria in malaria_data['malaria_data']:
-        matching_country = next((
-            country for country in country_data if country['iso'] == malaria['iso']), None)
-        if matching_country:
-            malaria.update(matching_country)
+    load_country_index(params['iso'])
+    body, unmatched = filter_body(malaria_data, fields, fmt)
 
-    return jsonify(malaria_data)   
+    response = json_payload_response(body, request, Response)
+    response.headers['X-Unmatched-Rows'] = unmatched
+    return response
 
 # For visual initialization, not meant to be called frequently
 @app.route('/api/malaria/') 
 def get_all_malaria():
-    malaria_data = make_api_request(API_URLS['malaria']['all'], 'GET').json
-    country_data = make_api_request(API_URLS['country']['get'], 'GET').json
+    fields, fmt, error = payload_args(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+
+    # Always streamed, whether or not the dataset is cached: rows are parsed, enriched and written
+    # one at a time, so memory does not grow with the dataset. The body is not known up front,
+    # so unlike /api/malaria/filter there is no ETag, and only gzip is applied on the fly.
+    url = API_URLS['malaria']['all']
+    malaria_rows = upstream_cache.peek(upstream_cache.make_key(url))
+    if malaria_rows is None:
+        upstream, error = open_api_stream(url)
+        if error:
+            return jsonify(error)
+        malaria_rows = iter_api_rows(upstream)
+
+    load_country_index()
+
+    def enriched_rows():
+        counts = {'unmatched': 0}
+        for malaria in malaria_rows:
+            yield enrich_row(malaria, fields, counts)
+        log_unmatched(counts)
+
+    if fmt == 'columns':
+        chunks = iter_json_columns_text(enriched_rows(), dump_json, fields)
+    else:
+        chunks = iter_json_array_text(enriched_rows(), dump_json)
+    if request.accept_encodings['gzip']:
+        response = Response(gzip_stream(chunks), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(chunks, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/api/malaria/clusters')
+def get_malaria_clusters():
+    bbox, zoom, years, error = cluster_args(request.args)
+    if error:
+        return jsonify({'error': error}), 400
 
-    for malaria in malaria_data:
-        matching_country = next((
-            country for country in country_data if country['iso'] == malaria['iso']), None)
-        if matching_country:
-            malaria.update(matching_country)
+    malaria_data = fetch_api_data(API_URLS['malaria']['all'], 'GET')
+    if not isinstance(malaria_data, list):
+        return jsonify(malaria_data)
 
-    return jsonify(malaria_data) 
+    load_country_index()
+    return json_payload_response(clusters_body(malaria_data, bbox, zoom, years), request, Response)
 
 @app.route('/api/malaria/iso/')
 def get_all_malaria_iso():
@@ -166,7 +737,7 @@ def get_malaria_by_iso(iso):
     country_url = API_URLS['country']['iso/<iso>'].replace('<iso>', iso)
 
     coroutine = fetch_data([malaria_url, country_url], 'GET')
-    responses = run_in_new_loop(coroutine)
+    responses = run_in_worker_loop(coroutine)
 
     return jsonify(responses)
 
@@ -176,17 +747,25 @@ def get_malaria_async_by_id(id):
     country_url = API_URLS['country']['<id>'].replace('<id>', str(id))
 
     coroutine = fetch_data([malaria_url, country_url], 'GET')
-    responses = run_in_new_loop(coroutine)
+    responses = run_in_worker_loop(coroutine)
 
     return jsonify(responses)
 
+@app.route('/api/malaria_country/batch', methods=['GET', 'POST'])
+def get_malaria_country_batch():
+    kind, keys, error = batch_keys(request.get_json(silent=True), request.args)
+    if error:
+        return jsonify({'error': error}), 400
+
+    return jsonify(run_in_worker_loop(fetch_malaria_country_batch(kind, keys)))
+
 @app.route('/api/malaria_country/sync/<int:id>')
 def get_malaria_sync_by_id(id):
     malaria_url = API_URLS['malaria']['<id>'].replace('<id>', str(id))
     country_url = API_URLS['country']['<id>'].replace('<id>', str(id))
 
-    malaria_response = make_api_request(malaria_url, 'GET').json
-    country_response = make_api_request(country_url, 'GET').json
+    malaria_response = fetch_api_data(malaria_url, 'GET')
+    country_response = fetch_api_data(country_url, 'GET')
 
     return jsonify([malaria_response, country_response])
 
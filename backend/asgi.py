@@ -0,0 +1,198 @@
+import asyncio
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+from app import (
+    app as wsgi_app, API_URLS, SNAPSHOT_MODE, upstream_cache,
+    after_reset, aiter_api_rows, async_fetch_api_data, async_load_country_index, dump_json,
+    batch_keys, cluster_args, clusters_body, enrich_row, fetch_data, fetch_malaria_country_batch, filter_body, filter_params, log_unmatched, open_async_api_stream,
+    payload_args, query_snapshot, snapshot_response, close_async_transport
+)
+from json_stream import aiter_json_array_text, aiter_json_columns_text
+from payload import agzip_stream, json_payload_response
+
+### Async (ASGI) serving mode ###
+# Same routes as app.py, but upstream I/O is awaited on the server's event loop, so a worker
+# is not held for the length of an upstream call. Run with: hypercorn asgi:app
+# The caches, country index and snapshot store are the ones in app.py.
+
+app = Quart(__name__)
+app.json.sort_keys = False
+app = cors(app, allow_origin='*')
+
+@app.after_serving
+async def shutdown():
+    await close_async_transport()
+
+def _query_snapshot(params):
+    # The snapshot store is a Flask-SQLAlchemy extension of the WSGI app
+    with wsgi_app.app_context():
+        return query_snapshot(params)
+
+# NOTE: This route is needed for the default EB health check route
+@app.route('/')
+async def home():
+    return "Ok"
+
+### Reset databases - Not to be consumed by frontend ###
+
+@app.route('/api/reset/malaria/', methods=['PUT'])
+async def reset_malaria_db():
+    response = await async_fetch_api_data(API_URLS['malaria']['reset'], 'PUT')
+    after_reset('malaria')
+    return jsonify(response)
+
+@app.route('/api/reset/country/', methods=['PUT'])
+async def reset_country_db():
+    response = await async_fetch_api_data(API_URLS['country']['reset'], 'PUT')
+    after_reset('country')
+    return jsonify(response)
+
+@app.route('/api/reset/', methods=['PUT'])
+async def reset_all_dbs():
+    malaria_response, country_response = await asyncio.gather(
+        async_fetch_api_data(API_URLS['malaria']['reset'], 'PUT'),
+        async_fetch_api_data(API_URLS['country']['reset'], 'PUT'))
+    after_reset('malaria', 'country')
+
+    return jsonify({
+        'malaria': malaria_response,
+        'country': country_response
+    })
+
+### Country and Malaria resources ###
+
+@app.route('/api/country/')
+async def get_country():
+    params = {'iso': request.args.get('iso')}
+    return jsonify(await async_fetch_api_data(API_URLS['country']['get'], 'GET', params=params))
+
+@app.route('/api/malaria/filter')
+async def filter_malaria():
+    params = filter_params(request.args)
+    fields, fmt, error = payload_args(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+
+    snapshot_data = await asyncio.to_thread(_query_snapshot, params) if SNAPSHOT_MODE else None
+    if snapshot_data is not None:
+        return snapshot_response(snapshot_data, fields, fmt, request, Response)
+
+    malaria_data, _ = await asyncio.gather(
+        async_fetch_api_data(API_URLS['malaria']['filter'], 'GET', params=params),
+        async_load_country_index(params['iso']))
+    if 'malaria_data' not in malaria_data:
+        return jsonify(malaria_data)
+
+    body, unmatched = filter_body(malaria_data, fields, fmt)
+
+    response = json_payload_response(body, request, Response)
+    response.headers['X-Unmatched-Rows'] = str(unmatched)
+    return response
+
+# For visual initialization, not meant to be called frequently
+@app.route('/api/malaria/')
+async def get_all_malaria():
+    fields, fmt, error = payload_args(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+
+    # Always streamed, like the WSGI route
+    url = API_URLS['malaria']['all']
+    cached_rows = upstream_cache.peek(upstream_cache.make_key(url))
+    if cached_rows is None:
+        upstream, error = await open_async_api_stream(url)
+        if error:
+            return jsonify(error)
+        malaria_rows = aiter_api_rows(upstream)
+    else:
+        upstream = None
+        malaria_rows = _aiter(cached_rows)
+
+    try:
+        await async_load_country_index()
+    except BaseException:
+        if upstream is not None:
+            upstream.release()     # the rows were never read, so give back the upstream slot now
+        raise
+
+    async def enriched_rows():
+        counts = {'unmatched': 0}
+        async for malaria in malaria_rows:
+            yield enrich_row(malaria, fields, counts)
+        log_unmatched(counts)
+
+    if fmt == 'columns':
+        chunks = aiter_json_columns_text(enriched_rows(), dump_json, fields)
+    else:
+        chunks = aiter_json_array_text(enriched_rows(), dump_json)
+    if request.accept_encodings['gzip']:
+        response = Response(agzip_stream(chunks), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(_encode_chunks(chunks), mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    return response
+
+async def _aiter(rows):
+    for row in rows:
+        yield row
+
+async def _encode_chunks(chunks):
+    async for chunk in chunks:
+        yield chunk.encode()
+
+@app.route('/api/malaria/clusters')
+async def get_malaria_clusters():
+    bbox, zoom, years, error = cluster_args(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+
+    malaria_data, _ = await asyncio.gather(
+        async_fetch_api_data(API_URLS['malaria']['all'], 'GET'),
+        async_load_country_index())
+    if not isinstance(malaria_data, list):
+        return jsonify(malaria_data)
+
+    return json_payload_response(clusters_body(malaria_data, bbox, zoom, years), request, Response)
+
+@app.route('/api/malaria/iso/')
+async def get_all_malaria_iso():
+    return jsonify(await async_fetch_api_data(API_URLS['malaria']['iso'], 'GET'))
+
+### Async methods E6156 requirements only. NOT meant to be consumed ###
+
+@app.route('/api/malaria_country/iso/<string:iso>')
+async def get_malaria_by_iso(iso):
+    malaria_url = API_URLS['malaria']['iso/<iso>'].replace('<iso>', iso)
+    country_url = API_URLS['country']['iso/<iso>'].replace('<iso>', iso)
+
+    return jsonify(await fetch_data([malaria_url, country_url], 'GET'))
+
+@app.route('/api/malaria_country/async/<int:id>')
+async def get_malaria_async_by_id(id):
+    malaria_url = API_URLS['malaria']['<id>'].replace('<id>', str(id))
+    country_url = API_URLS['country']['<id>'].replace('<id>', str(id))
+
+    return jsonify(await fetch_data([malaria_url, country_url], 'GET'))
+
+@app.route('/api/malaria_country/batch', methods=['GET', 'POST'])
+async def get_malaria_country_batch():
+    kind, keys, error = batch_keys(await request.get_json(silent=True), request.args)
+    if error:
+        return jsonify({'error': error}), 400
+
+    return jsonify(await fetch_malaria_country_batch(kind, keys))
+
+# Still one upstream call after the other, for comparison with the async route
+@app.route('/api/malaria_country/sync/<int:id>')
+async def get_malaria_sync_by_id(id):
+    malaria_url = API_URLS['malaria']['<id>'].replace('<id>', str(id))
+    country_url = API_URLS['country']['<id>'].replace('<id>', str(id))
+
+    malaria_response = await async_fetch_api_data(malaria_url, 'GET')
+    country_response = await async_fetch_api_data(country_url, 'GET')
+
+    return jsonify([malaria_response, country_response])
+
+if __name__ == '__main__':
+    app.run(debug=True, port=8080)
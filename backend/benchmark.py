@@ -0,0 +1,233 @@
+import argparse, asyncio, json, math, os, platform, subprocess, sys, time
+from datetime import datetime, timezone
+import aiohttp
+from stub_services import add_stub_arguments
+
+### Load benchmark for the backend ###
+# Starts the stand-in services from stub_services.py and the backend (WSGI or ASGI) pointed at
+# them, then drives every route at fixed concurrency levels. Reports p50/p95/p99 latency,
+# requests/s and upstream calls per request, and saves the results as JSON.
+#
+#   python benchmark.py --server wsgi --output wsgi.json
+#   python benchmark.py --server asgi --output asgi.json --compare wsgi.json
+
+# (name, method, path, JSON body). Resets come last, since they empty the backend's caches.
+ROUTES = [
+    ('home', 'GET', '/', None),
+    ('country', 'GET', '/api/country/', None),
+    ('country_iso', 'GET', '/api/country/?iso=AAB', None),
+    ('malaria_filter', 'GET', '/api/malaria/filter', None),
+    ('malaria_filter_map', 'GET', '/api/malaria/filter?per_page=200&fields=latlng,region,population,cases_median', None),
+    ('malaria_filter_iso_year', 'GET', '/api/malaria/filter?iso=AAA,AAB&year=2001,2002', None),
+    ('malaria_all', 'GET', '/api/malaria/', None),
+    ('malaria_clusters', 'GET', '/api/malaria/clusters?zoom=3&bbox=-180,-90,180,90', None),
+    ('malaria_iso', 'GET', '/api/malaria/iso/', None),
+    ('malaria_country_iso', 'GET', '/api/malaria_country/iso/AAC', None),
+    ('malaria_country_async', 'GET', '/api/malaria_country/async/3', None),
+    ('malaria_country_sync', 'GET', '/api/malaria_country/sync/3', None),
+    ('malaria_country_batch_iso', 'POST', '/api/malaria_country/batch', {'iso': ['AAA', 'AAB', 'AAC', 'AAD', 'AAE']}),
+    ('malaria_country_batch_ids', 'POST', '/api/malaria_country/batch', {'ids': [1, 2, 3, 4, 5]}),
+    ('reset_malaria', 'PUT', '/api/reset/malaria/', None),
+    ('reset_country', 'PUT', '/api/reset/country/', None),
+    ('reset_all', 'PUT', '/api/reset/', None)
+]
+
+SERVER_COMMANDS = {
+    'wsgi': lambda args: ['gunicorn', 'wsgi:app', '-w', str(args.workers), '-b', f'127.0.0.1:{args.port}', '-t', '30'],
+    'asgi': lambda args: ['hypercorn', 'asgi:app', '--workers', str(args.workers), '--bind', f'127.0.0.1:{args.port}']
+}
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest rank: the smallest value with at least this fraction of the values at or below it
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+async def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up within {timeout}s')
+
+async def upstream_calls(session, stub_urls):
+    totals = {}
+    for service, url in stub_urls.items():
+        async with session.get(url) as response:
+            totals[service] = (await response.json())['total']
+    return totals
+
+async def reset_upstream_calls(session, stub_urls):
+    for url in stub_urls.values():
+        async with session.delete(url) as response:
+            await response.read()
+
+async def run_level(session, base_url, route, concurrency, requests):
+    name, method, path, body = route
+    latencies = []
+    statuses = {}
+    errors = 0
+    received = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors, received
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path, json=body) as response:
+                    data = await response.read()
+                    received += len(data)
+                    statuses[response.status] = statuses.get(response.status, 0) + 1
+                    if response.status >= 400:
+                        errors += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                errors += 1
+                statuses['failed'] = statuses.get('failed', 0) + 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_s': round(requests / elapsed, 1) if elapsed else None,
+        'bytes_per_response': round(received / requests) if requests else None,
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+            for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+        }
+    }
+
+async def run_benchmark(args, base_url, stub_urls):
+    routes = [route for route in ROUTES if not args.routes or any(part in route[0] for part in args.routes)]
+    results = []
+    timeout = aiohttp.ClientTimeout(total=60)
+    connector = aiohttp.TCPConnector(limit=max(args.concurrency))
+    # Bodies are counted as sent, without decompressing them
+    headers = {'Accept-Encoding': args.accept_encoding}
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector, headers=headers,
+                                     auto_decompress=False) as session:
+        for route in routes:
+            for concurrency in args.concurrency:
+                for _ in range(args.warmup):
+                    async with session.request(route[1], base_url + route[2], json=route[3]) as response:
+                        await response.read()
+
+                await reset_upstream_calls(session, stub_urls)
+                result = await run_level(session, base_url, route, concurrency, args.requests)
+                calls = await upstream_calls(session, stub_urls)
+                result.update({
+                    'route': route[0],
+                    'method': route[1],
+                    'path': route[2],
+                    'concurrency': concurrency,
+                    'upstream_calls': calls,
+                    'upstream_calls_per_request': round(sum(calls.values()) / args.requests, 3) if args.requests else None
+                })
+                results.append(result)
+                print(f"{route[0]:<28} c={concurrency:<4} {result['requests_per_s']:>8} req/s  "
+                      f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+                      f"p99={result['latency_ms']['p99']}ms  {result['bytes_per_response']}B  upstream/req={result['upstream_calls_per_request']}  "
+                      f"errors={result['errors']}", flush=True)
+    return results
+
+def compare(results, previous_path):
+    """Print the change in requests/s and p95 latency against a previous results file."""
+    with open(previous_path) as f:
+        previous = {(r['route'], r['concurrency']): r for r in json.load(f)['results']}
+
+    print(f'\nCompared with {previous_path}:')
+    for result in results:
+        before = previous.get((result['route'], result['concurrency']))
+        if before is None:
+            continue
+        rps = _change(result['requests_per_s'], before['requests_per_s'])
+        p95 = _change(result['latency_ms']['p95'], before['latency_ms']['p95'])
+        print(f"{result['route']:<28} c={result['concurrency']:<4} req/s {rps}  p95 {p95}")
+
+def _change(after, before):
+    if not before or after is None:
+        return '     n/a'
+    return f'{(after - before) / before * 100:+6.1f}%'
+
+def start_process(command, env=None):
+    return subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the backend against local stand-in services.')
+    parser.add_argument('--server', choices=sorted(SERVER_COMMANDS), default='wsgi')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--concurrency', type=lambda value: [int(level) for level in value.split(',')], default=[1, 8, 32],
+                        help='comma-separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route and concurrency level')
+    parser.add_argument('--warmup', type=int, default=3, help='unmeasured requests before each level')
+    parser.add_argument('--accept-encoding', default='gzip, br', help='sent with every request, as a browser would')
+    parser.add_argument('--routes', nargs='*', help='only run routes whose name contains one of these')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='previous results file to compare against')
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    if args.requests < 1:
+        parser.error('--requests must be at least 1')
+
+    stub_command = [sys.executable, 'stub_services.py'] + [
+        f'--{name}={getattr(args, name.replace("-", "_"))}'
+        for name in ('host', 'malaria-port', 'country-port', 'latency-ms', 'jitter-ms', 'error-rate',
+                     'countries', 'years', 'pad-bytes', 'seed')]
+    stub_urls = {
+        'malaria': f'http://{args.host}:{args.malaria_port}/_stats',
+        'country': f'http://{args.host}:{args.country_port}/_stats'
+    }
+    server_env = dict(os.environ,
+                      MALARIA_BASE_URL=f'http://{args.host}:{args.malaria_port}/api',
+                      COUNTRY_BASE_URL=f'http://{args.host}:{args.country_port}/api')
+    base_url = f'http://127.0.0.1:{args.port}'
+
+    stubs = start_process(stub_command)
+    server = start_process(SERVER_COMMANDS[args.server](args), env=server_env)
+    try:
+        asyncio.run(wait_until_up(stub_urls['malaria']))
+        asyncio.run(wait_until_up(base_url + '/'))
+        results = asyncio.run(run_benchmark(args, base_url, stub_urls))
+    finally:
+        stop_process(server)
+        stop_process(stubs)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nResults saved to {args.output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import math, statistics, threading
+from collections import OrderedDict
+
+MAX_ZOOM = 12
+
+def cell_size(zoom):
+    """Width and height, in degrees, of a grid cell at this zoom. Each zoom level halves it."""
+    return 360 / 2 ** zoom
+
+def parse_bbox(value):
+    """Parse a west,south,east,north bounding box. west > east means it crosses the antimeridian."""
+    try:
+        west, south, east, north = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+        return None
+    return west, south, east, north
+
+class ClusterIndex:
+    """Grid index over malaria rows joined to country latlng, aggregated per zoom level.
+
+    Each zoom level is a grid of square cells, so cells nest like a quadtree. The aggregated
+    cells of each (years, zoom) pair are built on first use and kept until the data changes.
+    """
+
+    def __init__(self, max_levels=128):
+        self.max_levels = max_levels
+        self.skipped = 0                # rows without usable coordinates
+        self._source = None
+        self._points = {}               # year -> [(lat, lng, cases), ...]
+        self._levels = OrderedDict()    # (years, zoom) -> {(cx, cy): cluster}
+        self._lock = threading.Lock()
+
+    def ensure(self, source, version, rows):
+        """Rebuild from rows (an iterable of joined rows) unless this source object and version are indexed."""
+        with self._lock:
+            if self._source is not None and self._source[0] is source and self._source[1] == version:
+                return
+            points = {}
+            skipped = 0
+            for row in rows:
+                latlng = row.get('latlng')
+                if not isinstance(latlng, (list, tuple)) or len(latlng) < 2 or None in latlng[:2]:
+                    skipped += 1
+                    continue
+                points.setdefault(row.get('year'), []).append(
+                    (float(latlng[0]), float(latlng[1]), row.get('cases_median')))
+            self._points = points
+            self._levels.clear()
+            self.skipped = skipped
+            self._source = (source, version)
+
+    def clusters(self, bbox, zoom, years=None):
+        """Return the clusters whose cells overlap bbox, at most one per visible cell."""
+        cells = self._level(tuple(sorted(years)) if years else None, zoom)
+        size = cell_size(zoom)
+        west, south, east, north = bbox
+
+        x_ranges = [(west, east)] if west <= east else [(west, 180), (-180, east)]
+        y_min, y_max = self._cell(south, size, 90), self._cell(north, size, 90)
+        visible = []
+        for x_west, x_east in x_ranges:
+            x_min, x_max = self._cell(x_west, size, 180), self._cell(x_east, size, 180)
+            if (x_max - x_min + 1) * (y_max - y_min + 1) < len(cells):
+                keys = ((cx, cy) for cx in range(x_min, x_max + 1) for cy in range(y_min, y_max + 1))
+                visible.extend(cells[key] for key in keys if key in cells)
+            else:
+                visible.extend(cluster for (cx, cy), cluster in cells.items()
+                               if x_min <= cx <= x_max and y_min <= cy <= y_max)
+        return visible
+
+    def _level(self, years, zoom):
+        key = (years, zoom)
+        with self._lock:
+            if key in self._levels:
+                self._levels.move_to_end(key)
+                return self._levels[key]
+            source = self._source
+            points = self._points_for(years)
+
+        grouped = {}
+        size = cell_size(zoom)
+        for lat, lng, cases in points:
+            grouped.setdefault((self._cell(lng, size, 180), self._cell(lat, size, 90)), []).append((lat, lng, cases))
+        cells = {cell: self._aggregate(cell, members) for cell, members in grouped.items()}
+
+        with self._lock:
+            if self._source is not source:
+                return cells    # rebuilt meanwhile, do not keep cells of the old data
+            self._levels[key] = cells
+            while len(self._levels) > self.max_levels:
+                self._levels.popitem(last=False)
+        return cells
+
+    def _points_for(self, years):
+        if years is None:
+            return [point for year_points in self._points.values() for point in year_points]
+        by_str = {str(year): year for year in self._points}
+        return [point for year in years for point in self._points.get(by_str.get(str(year)), [])]
+
+    @staticmethod
+    def _cell(degrees, size, offset):
+        # The last cell is closed, so 180 and 90 fall inside the grid
+        return min(math.floor((degrees + offset) / size), math.ceil(2 * offset / size) - 1)
+
+    @staticmethod
+    def _aggregate(cell, members):
+        cases = [case for _, _, case in members if isinstance(case, (int, float))]
+        return {
+            'cell': list(cell),
+            'count': len(members),
+            'cases_sum': sum(cases),
+            'cases_median': statistics.median(cases) if cases else None,
+            'centroid': [
+                sum(lat for lat, _, _ in members) / len(members),
+                sum(lng for _, lng, _ in members) / len(members)
+            ]
+        }
@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+
+class CountryIndex:
+    """ISO-keyed index of country records, kept across requests and used to enrich malaria rows.
+
+    The index remembers which country lists it was built from, so handing it the same
+    (cached) list again is free. A new list only touches the records that changed.
+    """
+
+    def __init__(self, max_partial_sources=32):
+        self.version = 0
+        self.max_partial_sources = max_partial_sources
+        self._by_iso = {}
+        self._all = None                # last complete country list applied
+        self._partial = OrderedDict()   # source key -> last partial list applied for it, LRU
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_iso)
+
+    def get(self, iso):
+        return self._by_iso.get(iso)
+
+    def update(self, countries, source='all', complete=True):
+        """Apply a country list. A complete list also drops ISO codes missing from it."""
+        if not isinstance(countries, list):
+            return
+        with self._lock:
+            if (self._all if complete else self._partial.get(source)) is countries:
+                if not complete:
+                    self._partial.move_to_end(source)
+                return
+
+            changed = False
+            seen = set()
+            for country in countries:
+                iso = country.get('iso')
+                seen.add(iso)
+                if self._by_iso.get(iso) != country:
+                    self._by_iso[iso] = country
+                    changed = True
+            if complete:
+                for iso in [iso for iso in self._by_iso if iso not in seen]:
+                    del self._by_iso[iso]
+                    changed = True
+                self._all = countries
+                self._partial.clear()   # partial sources may be stale against the new full list
+            else:
+                # Sources come from user-supplied iso= values, so only the recent ones are kept
+                self._partial[source] = countries
+                self._partial.move_to_end(source)
+                while len(self._partial) > self.max_partial_sources:
+                    self._partial.popitem(last=False)
+
+            if changed:
+                self.version += 1
+
+    def join_row(self, malaria):
+        """Return (row, matched) with the malaria row merged with its country, without mutating it."""
+        country = self._by_iso.get(malaria.get('iso'))
+        if country:
+            return {**malaria, **country}, True
+        return dict(malaria), False
+
+    def join(self, malaria_rows):
+        """Return (enriched_rows, unmatched) for a list of malaria rows, in one pass.
+
+        Rows are copied rather than updated in place, since they may be shared with the cache.
+        """
+        enriched = []
+        unmatched = 0
+        for malaria in malaria_rows:
+            row, matched = self.join_row(malaria)
+            enriched.append(row)
+            unmatched += not matched
+        return enriched, unmatched
+
+    def clear(self):
+        with self._lock:
+            self._by_iso = {}
+            self._all = None
+            self._partial.clear()
+            self.version += 1
@@ -0,0 +1,189 @@
+import codecs, json, tempfile
+
+_WHITESPACE = ' \t\n\r'
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class JsonArrayParser:
+    """Incremental parser for a top-level JSON array fed in byte chunks.
+
+    Only one element (plus the unparsed tail of the current chunk) is held at a time.
+    """
+
+    def __init__(self, encoding='utf-8'):
+        self.done = False
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder(encoding)()
+        self._buffer = ''
+        self._started = False
+
+    def feed(self, chunk):
+        """Return the elements completed by this chunk."""
+        if self.done:
+            return []
+        buffer = self._buffer + self._text_decoder.decode(chunk)
+        elements = []
+        pos = 0
+        while True:
+            while pos < len(buffer) and (buffer[pos] in _WHITESPACE or (self._started and buffer[pos] == ',')):
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if not self._started:
+                if buffer[pos] != '[':
+                    raise ValueError('Expected a JSON array')
+                self._started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                self.done = True
+                pos = len(buffer)
+                break
+            try:
+                element, end = self._decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break       # element continues in the next chunk
+            if _is_number(element) and (end == len(buffer) or buffer[end] in '.eE'):
+                break       # the number may continue in the next chunk, as in '-4500.' + '0'
+            elements.append(element)
+            pos = end
+        self._buffer = buffer[pos:]
+        return elements
+
+    def close(self):
+        if not self.done:
+            raise ValueError('Unterminated JSON array')
+
+def iter_json_array(chunks, encoding='utf-8'):
+    """Yield the elements of a top-level JSON array as its bytes arrive from chunks."""
+    parser = JsonArrayParser(encoding)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
+    parser.close()
+
+async def aiter_json_array(chunks, encoding='utf-8'):
+    """Async version of iter_json_array, for chunks from an async iterator."""
+    parser = JsonArrayParser(encoding)
+    async for chunk in chunks:
+        for element in parser.feed(chunk):
+            yield element
+        if parser.done:
+            return
+    parser.close()
+
+class _ArrayTextBuffer:
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self._parts = ['[']
+        self._size = 1
+        self._first = True
+
+    def add(self, text):
+        """Add one serialized element, returning a chunk once about chunk_size has built up."""
+        part = text if self._first else ',' + text
+        self._first = False
+        self._parts.append(part)
+        self._size += len(part)
+        if self._size >= self.chunk_size:
+            return self._take()
+        return None
+
+    def close(self):
+        self._parts.append(']')
+        return self._take()
+
+    def _take(self):
+        chunk = ''.join(self._parts)
+        self._parts, self._size = [], 0
+        return chunk
+
+def iter_json_array_text(rows, dumps, chunk_size=64 * 1024):
+    """Serialize rows as one JSON array, yielding text in chunks of about chunk_size."""
+    buffer = _ArrayTextBuffer(chunk_size)
+    for row in rows:
+        chunk = buffer.add(dumps(row))
+        if chunk:
+            yield chunk
+    yield buffer.close()
+
+async def aiter_json_array_text(rows, dumps, chunk_size=64 * 1024):
+    """Async version of iter_json_array_text, for rows from an async iterator."""
+    buffer = _ArrayTextBuffer(chunk_size)
+    async for row in rows:
+        chunk = buffer.add(dumps(row))
+        if chunk:
+            yield chunk
+    yield buffer.close()
+
+class _ColumnSpool:
+    """Collects rows as serialized columns, each spilling to a temp file past max_memory characters."""
+
+    def __init__(self, fields, dumps, max_memory):
+        self.dumps = dumps
+        self.max_memory = max_memory
+        self._fixed = fields is not None
+        self._columns = {}          # field -> file holding its comma-separated values
+        self._rows = 0
+        for field in fields or ():
+            self._columns[field] = self._new_column()
+
+    def _new_column(self):
+        column = tempfile.SpooledTemporaryFile(self.max_memory, mode='w+', encoding='utf-8')
+        column.write(','.join(['null'] * self._rows))     # rows seen before the field first appeared
+        return column
+
+    def add(self, row):
+        if not self._fixed:
+            for field in row:
+                if field not in self._columns:
+                    self._columns[field] = self._new_column()
+        separator = ',' if self._rows else ''
+        for field, column in self._columns.items():
+            column.write(separator + self.dumps(row.get(field)))
+        self._rows += 1
+
+    def chunks(self, chunk_size):
+        """Yield the collected columns as one {field: [values...]} JSON object."""
+        yield '{'
+        for index, (field, column) in enumerate(self._columns.items()):
+            yield (',' if index else '') + self.dumps(field) + ':['
+            column.seek(0)
+            while True:
+                data = column.read(chunk_size)
+                if not data:
+                    break
+                yield data
+            yield ']'
+        yield '}'
+
+    def close(self):
+        for column in self._columns.values():
+            column.close()
+
+def iter_json_columns_text(rows, dumps, fields=None, chunk_size=64 * 1024, max_memory=1024 * 1024):
+    """Serialize rows in the layout of payload.to_columns, yielding text in chunks.
+
+    Columns are written out as rows arrive and spill to temp files past max_memory characters
+    each, so memory does not grow with the row count. Nothing is yielded until the last row.
+    """
+    spool = _ColumnSpool(fields, dumps, max_memory)
+    try:
+        for row in rows:
+            spool.add(row)
+        yield from spool.chunks(chunk_size)
+    finally:
+        spool.close()
+
+async def aiter_json_columns_text(rows, dumps, fields=None, chunk_size=64 * 1024, max_memory=1024 * 1024):
+    """Async version of iter_json_columns_text, for rows from an async iterator."""
+    spool = _ColumnSpool(fields, dumps, max_memory)
+    try:
+        async for row in rows:
+            spool.add(row)
+        for chunk in spool.chunks(chunk_size):
+            yield chunk
+    finally:
+        spool.close()
@@ -0,0 +1,106 @@
+import gzip, hashlib, threading, zlib
+from collections import OrderedDict
+import brotli
+
+MIN_COMPRESS_BYTES = 1024      # smaller bodies are not worth the CPU
+ENCODERS = {
+    'br': lambda body: brotli.compress(body, quality=5),
+    'gzip': lambda body: gzip.compress(body, compresslevel=6)
+}
+
+def parse_fields(value):
+    """Turn a fields=a,b,c query argument into a list of field names, or None for all fields."""
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    return fields or None
+
+def project(row, fields):
+    if fields is None:
+        return row
+    return {field: row[field] for field in fields if field in row}
+
+def to_columns(rows, fields=None):
+    """Turn a list of rows into {field: [values...]}. Missing values become null."""
+    if fields is None:
+        fields = list(dict.fromkeys(field for row in rows for field in row))
+    return {field: [row.get(field) for row in rows] for field in fields}
+
+def shape_rows(rows, fields, fmt):
+    """Apply the fields= projection and the format= layout ('rows' or 'columns') to a list of rows."""
+    if fmt == 'columns':
+        return to_columns(rows, fields)
+    return [project(row, fields) for row in rows]
+
+class EncodedPayloadCache:
+    """Small LRU of compressed bodies keyed by (digest, encoding), so repeat loads are not re-encoded."""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_encode(self, digest, encoding, body):
+        key = (digest, encoding)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        encoded = ENCODERS[encoding](body)
+        with self._lock:
+            self._entries[key] = encoded
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return encoded
+
+encoded_payloads = EncodedPayloadCache()
+
+def negotiate_encoding(request, size):
+    if size < MIN_COMPRESS_BYTES:
+        return None
+    return request.accept_encodings.best_match(list(ENCODERS))
+
+def json_payload_response(body, request, response_class):
+    """Return body (serialized JSON bytes) with a strong ETag, compressed if the client accepts it.
+
+    request and response_class come from the serving framework (Flask or Quart). Each encoding
+    is a separate representation with its own ETag, and a matching If-None-Match gets a 304
+    before anything is compressed.
+    """
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    encoding = negotiate_encoding(request, len(body))
+    etag = f'{digest}-{encoding}' if encoding else digest
+
+    if request.if_none_match.contains(etag):
+        response = response_class(status=304)
+    else:
+        data = encoded_payloads.get_or_encode(digest, encoding, body) if encoding else body
+        response = response_class(data, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def _gzip_compressor():
+    return zlib.compressobj(6, zlib.DEFLATED, 31)      # wbits=31 writes a gzip header
+
+def gzip_stream(chunks):
+    """Gzip a stream of text chunks on the fly, for bodies too large to hold in memory."""
+    compressor = _gzip_compressor()
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+async def agzip_stream(chunks):
+    """Async version of gzip_stream, for chunks from an async iterator."""
+    compressor = _gzip_compressor()
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,214 @@
+import os, socket, threading, time
+from datetime import datetime, timezone
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+db = SQLAlchemy()
+
+class MalariaSnapshot(db.Model):
+    __tablename__ = 'malaria_snapshot'
+
+    position = db.Column(db.Integer, primary_key=True)     # order of the row in the upstream dataset
+    iso = db.Column(db.String(8), index=True)
+    year = db.Column(db.Integer, index=True)
+    region = db.Column(db.String(128), index=True)
+    who_region = db.Column(db.String(128), index=True)
+    data = db.Column(db.JSON, nullable=False)               # the joined malaria + country row, the
+                                                            # columns above are the malaria row's own
+
+class SnapshotMeta(db.Model):
+    __tablename__ = 'snapshot_meta'
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    built_at = db.Column(db.Float, nullable=False)          # unix timestamp
+    row_count = db.Column(db.Integer, nullable=False)
+    unmatched = db.Column(db.Integer, nullable=False)
+
+class SnapshotClaim(db.Model):
+    __tablename__ = 'snapshot_claim'
+
+    id = db.Column(db.Integer, primary_key=True)
+    owner = db.Column(db.String(128))                       # host:pid of the worker rebuilding
+    expires_at = db.Column(db.Float, nullable=False)        # unix timestamp
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class SnapshotStore:
+    """Local SQLite copy of the joined malaria + country dataset, used to answer /api/malaria/filter.
+
+    load_rows() returns (malaria_rows, rows, unmatched) from the live services, where rows are the
+    malaria rows joined to their countries, or None if the services are unavailable.
+    A background thread rebuilds the snapshot every refresh_seconds, or sooner after request_rebuild().
+    Every worker runs one, and a claim row in the database lets only one of them rebuild at a time.
+    """
+
+    def __init__(self, load_rows, refresh_seconds=900, retry_seconds=30, claim_seconds=300):
+        self.load_rows = load_rows
+        self.refresh_seconds = refresh_seconds
+        self.retry_seconds = retry_seconds
+        self.claim_seconds = claim_seconds      # a claim outlives a worker that died mid-rebuild by this much
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.app = None
+        self._wake = threading.Event()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+        db.init_app(app)
+        with app.app_context():
+            if db.engine.dialect.name == 'sqlite':
+                event.listen(db.engine, 'connect', _enable_wal)
+            db.create_all()
+
+        self._thread = threading.Thread(target=self._refresh_loop, name='snapshot-refresh', daemon=True)
+        self._thread.start()
+
+    def request_rebuild(self):
+        self._wake.set()
+
+    def rebuild(self):
+        loaded = self.load_rows()
+        if loaded is None:
+            return False
+        malaria_rows, rows, unmatched = loaded
+
+        meta = db.session.get(SnapshotMeta, 1)
+        version = meta.version + 1 if meta else 1
+        try:
+            db.session.execute(db.delete(MalariaSnapshot))
+            if rows:
+                # Filters match the malaria service's own fields, which country fields overwrite in the join
+                db.session.execute(insert(MalariaSnapshot), [{
+                    'position': position,
+                    'iso': malaria.get('iso'),
+                    'year': _to_int(malaria.get('year')),
+                    'region': malaria.get('region'),
+                    'who_region': malaria.get('who_region'),
+                    'data': row
+                } for position, (malaria, row) in enumerate(zip(malaria_rows, rows))])
+            db.session.merge(SnapshotMeta(
+                id=1, version=version, built_at=time.time(), row_count=len(rows), unmatched=unmatched))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return True
+
+    def meta(self):
+        meta = db.session.get(SnapshotMeta, 1)
+        if meta is None:
+            return None
+        return {
+            'version': meta.version,
+            'built_at': datetime.fromtimestamp(meta.built_at, timezone.utc).isoformat(),
+            'age_seconds': round(time.time() - meta.built_at, 1),
+            'row_count': meta.row_count,
+            'unmatched': meta.unmatched
+        }
+
+    def query(self, region=None, year=None, who_region=None, iso=None, page=1, per_page=10):
+        """Return a page of the filter results, or None if the snapshot cannot answer the query."""
+        meta = self.meta()
+        if meta is None or page < 1 or per_page < 1:
+            return None
+
+        filters = []
+        for column, value in ((MalariaSnapshot.region, region),
+                              (MalariaSnapshot.who_region, who_region),
+                              (MalariaSnapshot.iso, iso)):
+            if value:
+                filters.append(column.in_([v.strip() for v in value.split(',')]))
+        if year:
+            years = [_to_int(v) for v in year.split(',')]
+            if None in years:
+                return None
+            filters.append(MalariaSnapshot.year.in_(years))
+
+        total_items = db.session.scalar(select(func.count()).select_from(MalariaSnapshot).where(*filters))
+        rows = db.session.scalars(
+            select(MalariaSnapshot.data).where(*filters)
+            .order_by(MalariaSnapshot.position)
+            .limit(per_page).offset((page - 1) * per_page)).all()
+
+        return {
+            'malaria_data': rows,
+            'total_items': total_items,
+            'total_pages': -(-total_items // per_page),
+            'page': page,
+            'per_page': per_page,
+            'snapshot': meta
+        }
+
+    def _seconds_until_stale(self):
+        meta = db.session.get(SnapshotMeta, 1)
+        db.session.remove()
+        if meta is None:
+            return 0
+        return max(0, self.refresh_seconds - (time.time() - meta.built_at))
+
+    def claim(self):
+        """Claim the rebuild for this worker, unless another one holds an unexpired claim."""
+        now = time.time()
+        if db.session.get(SnapshotClaim, 1) is None:
+            try:
+                db.session.add(SnapshotClaim(id=1, owner=None, expires_at=0))
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()      # another worker created it first
+
+        # A single conditional UPDATE, so two workers cannot both see the claim as free
+        result = db.session.execute(
+            update(SnapshotClaim)
+            .where(SnapshotClaim.id == 1, or_(SnapshotClaim.expires_at < now, SnapshotClaim.owner == self.owner))
+            .values(owner=self.owner, expires_at=now + self.claim_seconds))
+        db.session.commit()
+        return result.rowcount == 1
+
+    def release(self):
+        db.session.execute(
+            update(SnapshotClaim)
+            .where(SnapshotClaim.id == 1, SnapshotClaim.owner == self.owner)
+            .values(expires_at=0))
+        db.session.commit()
+
+    def _refresh_loop(self):
+        with self.app.app_context():
+            forced = False
+            while True:
+                # Other workers share the database, so only rebuild once it is actually stale
+                forced = self._wake.wait(timeout=0 if forced else self._seconds_until_stale()) or forced
+                self._wake.clear()
+                if not forced and self._seconds_until_stale() > 0:
+                    continue
+
+                rebuilt = False
+                try:
+                    if not self.claim():
+                        # Another worker is rebuilding. A forced rebuild still runs after it, since it
+                        # may have loaded its rows before the reset; a scheduled one is then fresh.
+                        forced = self._wake.wait(timeout=self.retry_seconds) or forced
+                        self._wake.clear()
+                        continue
+                    try:
+                        rebuilt = self.rebuild()
+                        forced = forced and not rebuilt
+                    finally:
+                        self.release()
+                except Exception:
+                    self.app.logger.exception('Snapshot rebuild failed')
+                finally:
+                    db.session.remove()
+                if not rebuilt:
+                    self._wake.wait(timeout=self.retry_seconds)
+
+def _enable_wal(dbapi_connection, connection_record):
+    # Readers keep seeing the previous snapshot while a rebuild is being written
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.close()
@@ -0,0 +1,199 @@
+import argparse, asyncio, collections, itertools, json, random, string
+from aiohttp import web
+
+### Local stand-ins for the Malaria and Country services, used by benchmark.py ###
+# They serve the endpoints listed in app.py with generated data, a configurable latency and
+# error rate, and count the calls they get. GET /_stats returns the counts, DELETE resets them.
+
+REGIONS = ['Africa', 'Americas', 'Asia', 'Europe', 'Oceania']
+WHO_REGIONS = ['AFR', 'AMR', 'SEAR', 'EUR', 'EMR', 'WPR']
+
+def generate_data(countries, years, pad_bytes, seed=0):
+    rng = random.Random(seed)
+    isos = [''.join(letters) for letters in itertools.islice(itertools.product(string.ascii_uppercase, repeat=3), countries)]
+    padding = 'x' * pad_bytes
+
+    country_rows = []
+    for id, iso in enumerate(isos, start=1):
+        country_rows.append({
+            'id': id,
+            'iso': iso,
+            'name': f'Country {iso}',
+            'region': rng.choice(REGIONS),
+            'who_region': rng.choice(WHO_REGIONS),
+            'latlng': [round(rng.uniform(-60, 70), 4), round(rng.uniform(-180, 180), 4)],
+            'population': rng.randint(10 ** 4, 10 ** 9)
+        })
+
+    malaria_rows = []
+    for country in country_rows:
+        for year in range(2000, 2000 + years):
+            row = {
+                'id': len(malaria_rows) + 1,
+                'iso': country['iso'],
+                'year': year,
+                'region': country['region'],
+                'who_region': country['who_region'],
+                'cases_median': rng.randint(0, 10 ** 6)
+            }
+            if pad_bytes:
+                row['padding'] = padding
+            malaria_rows.append(row)
+    return malaria_rows, country_rows
+
+class StubService:
+    def __init__(self, name, latency_ms, jitter_ms, error_rate, seed=0):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.calls = collections.Counter()
+        self.rng = random.Random(seed)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path.startswith('/_stats'):
+            return await handler(request)
+
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.calls[f'{request.method} {route}'] += 1
+
+        delay = self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self.rng.random() < self.error_rate:
+            return web.Response(status=500, text='Injected error')
+        return await handler(request)
+
+    async def stats(self, request):
+        return web.json_response({'service': self.name, 'calls': dict(self.calls), 'total': sum(self.calls.values())})
+
+    async def reset_stats(self, request):
+        self.calls.clear()
+        return web.json_response({'service': self.name, 'calls': {}, 'total': 0})
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_delete('/_stats', self.reset_stats)
+        return app
+
+def _json(data):
+    # The real services answer with exactly this Content-Type, which app.py checks for
+    return web.Response(body=json.dumps(data).encode(), headers={'Content-Type': 'application/json'})
+
+def _multi(request, name):
+    value = request.query.get(name)
+    return set(value.split(',')) if value else None
+
+def make_malaria_app(service, malaria_rows):
+    by_id = {row['id']: row for row in malaria_rows}
+
+    async def reset(request):
+        return _json({'message': 'Malaria database reset'})
+
+    async def filter_rows(request):
+        rows = malaria_rows
+        for name in ('iso', 'region', 'who_region', 'year'):
+            values = _multi(request, name)
+            if values:
+                rows = [row for row in rows if str(row[name]) in values]
+        page = int(request.query.get('page', 1))
+        per_page = int(request.query.get('per_page', 10))
+        return _json({
+            'malaria_data': rows[(page - 1) * per_page:page * per_page],
+            'total_items': len(rows),
+            'total_pages': -(-len(rows) // per_page),
+            'page': page,
+            'per_page': per_page
+        })
+
+    async def all_rows(request):
+        return _json(malaria_rows)
+
+    async def isos(request):
+        return _json(sorted({row['iso'] for row in malaria_rows}))
+
+    async def by_iso(request):
+        return _json([row for row in malaria_rows if row['iso'] == request.match_info['iso']])
+
+    async def get_by_id(request):
+        row = by_id.get(int(request.match_info['id']))
+        return _json(row) if row else web.Response(status=404, text='Not found')
+
+    app = service.make_app()
+    app.router.add_put('/api/reset/malaria', reset)
+    app.router.add_get('/api/malaria/filter', filter_rows)
+    app.router.add_get('/api/malaria', all_rows)
+    app.router.add_get('/api/malaria/iso', isos)
+    app.router.add_get('/api/malaria/iso/{iso}', by_iso)
+    app.router.add_get('/api/malaria/{id:\\d+}', get_by_id)
+    return app
+
+def make_country_app(service, country_rows):
+    by_id = {row['id']: row for row in country_rows}
+    by_iso = {row['iso']: row for row in country_rows}
+
+    async def reset(request):
+        return _json({'message': 'Country database reset'})
+
+    async def get_countries(request):
+        values = _multi(request, 'iso')
+        return _json([row for row in country_rows if values is None or row['iso'] in values])
+
+    async def get_by_iso(request):
+        row = by_iso.get(request.match_info['iso'])
+        return _json(row) if row else web.Response(status=404, text='Not found')
+
+    async def get_by_id(request):
+        row = by_id.get(int(request.match_info['id']))
+        return _json(row) if row else web.Response(status=404, text='Not found')
+
+    app = service.make_app()
+    app.router.add_put('/api/reset/country', reset)
+    app.router.add_get('/api/country', get_countries)
+    app.router.add_get('/api/country/iso/{iso}', get_by_iso)
+    app.router.add_get('/api/country/{id:\\d+}', get_by_id)
+    return app
+
+async def serve(args):
+    malaria_rows, country_rows = generate_data(args.countries, args.years, args.pad_bytes, args.seed)
+    apps = [
+        (make_malaria_app(StubService('malaria', args.latency_ms, args.jitter_ms, args.error_rate, args.seed), malaria_rows), args.malaria_port),
+        (make_country_app(StubService('country', args.latency_ms, args.jitter_ms, args.error_rate, args.seed + 1), country_rows), args.country_port)
+    ]
+    runners = []
+    for app, port in apps:
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, args.host, port).start()
+        runners.append(runner)
+
+    print(f'Malaria stub on http://{args.host}:{args.malaria_port}/api, '
+          f'country stub on http://{args.host}:{args.country_port}/api '
+          f'({len(malaria_rows)} malaria rows, {len(country_rows)} countries)', flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+def add_stub_arguments(parser):
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--malaria-port', type=int, default=7071)
+    parser.add_argument('--country-port', type=int, default=7070)
+    parser.add_argument('--latency-ms', type=float, default=20, help='added to every upstream call')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='latency varies uniformly by +/- this much')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of calls answered with a 500')
+    parser.add_argument('--countries', type=int, default=200)
+    parser.add_argument('--years', type=int, default=20, help='malaria rows per country')
+    parser.add_argument('--pad-bytes', type=int, default=0, help='extra bytes per malaria row')
+    parser.add_argument('--seed', type=int, default=0)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run stand-in Malaria and Country services.')
+    add_stub_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
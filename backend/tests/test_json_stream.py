@@ -0,0 +1,107 @@
+import asyncio, json
+import pytest
+from json_stream import (
+    JsonArrayParser, aiter_json_array, aiter_json_columns_text, iter_json_array,
+    iter_json_array_text, iter_json_columns_text
+)
+from payload import to_columns
+
+ROWS = [
+    {'id': 1, 'iso': 'AGO', 'year': 2001, 'cases_median': -4500.0, 'latlng': [-11.5, 17.8]},
+    {'id': 2, 'iso': 'CIV', 'name': 'Côte d’Ivoire', 'cases_median': 1.5e-3, 'big': 12345678901234567890},
+    {'id': 3, 'iso': None, 'flag': True, 'other': False, 'nested': {'a': [1, 2.5, {'b': 'x,]y'}]}},
+    -4500.0, 7, 1e21, 2.5E-7, 'text', True, None, [], {}
+]
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+def _split(data, *positions):
+    bounds = [0, *positions, len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+def test_whole_array_in_one_chunk():
+    data = _dumps(ROWS).encode()
+    assert list(iter_json_array([data])) == ROWS
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_every_single_split_point(indent):
+    data = json.dumps(ROWS, indent=indent, ensure_ascii=False).encode()
+    for position in range(len(data) + 1):
+        assert list(iter_json_array(_split(data, position))) == ROWS, position
+
+def test_one_byte_chunks():
+    data = json.dumps(ROWS, indent=1, ensure_ascii=False).encode()
+    assert list(iter_json_array(data[i:i + 1] for i in range(len(data)))) == ROWS
+
+@pytest.mark.parametrize('chunks, expected', [
+    ([b'[-4500.', b'0]'], [-4500.0]),
+    ([b'[1', b'2', b'3]'], [123]),
+    ([b'[2', b'e3]'], [2000.0]),
+    ([b'[2e', b'-3]'], [0.002]),
+    ([b'[2.5E', b'+1]'], [25.0]),
+    ([b'[-', b'1]'], [-1]),
+    ([b'[1.5]'], [1.5])
+])
+def test_numbers_split_across_chunks(chunks, expected):
+    assert list(iter_json_array(chunks)) == expected
+
+def test_elements_are_returned_as_soon_as_they_are_complete():
+    parser = JsonArrayParser()
+    assert parser.feed(b'[{"a": 1}, {"b"') == [{'a': 1}]
+    assert parser.feed(b': 2}, 3') == [{'b': 2}]
+    assert parser.feed(b', 4') == [3]
+    assert parser.feed(b']') == [4]
+    assert parser.done
+
+def test_trailing_data_after_the_array_is_ignored():
+    assert list(iter_json_array([b'[1, 2] \n'])) == [1, 2]
+
+def test_empty_array():
+    assert list(iter_json_array([b' [ ', b' ] '])) == []
+
+@pytest.mark.parametrize('chunks', [[b'[1, 2'], [b'[1, -4500.'], [b'[{"a": 1}'], [b''], []])
+def test_unterminated_array(chunks):
+    with pytest.raises(ValueError, match='Unterminated JSON array'):
+        list(iter_json_array(chunks))
+
+def test_not_an_array():
+    with pytest.raises(ValueError, match='Expected a JSON array'):
+        list(iter_json_array([b'{"a": 1}']))
+
+def test_async_parser_splits_like_the_sync_one():
+    data = _dumps(ROWS).encode()
+
+    async def chunks():
+        for i in range(0, len(data), 7):
+            yield data[i:i + 7]
+
+    async def collect():
+        return [row async for row in aiter_json_array(chunks())]
+
+    assert asyncio.run(collect()) == ROWS
+
+@pytest.mark.parametrize('chunk_size', [1, 16, 64 * 1024])
+def test_array_text_round_trip(chunk_size):
+    rows = ROWS * 20
+    assert json.loads(''.join(iter_json_array_text(iter(rows), _dumps, chunk_size))) == rows
+    assert ''.join(iter_json_array_text(iter([]), _dumps)) == '[]'
+
+@pytest.mark.parametrize('fields', [None, ['iso', 'missing', 'id']])
+@pytest.mark.parametrize('max_memory', [1, 1024 * 1024])
+def test_columns_text_matches_to_columns(fields, max_memory):
+    rows = [row for row in ROWS if isinstance(row, dict)] * 5
+    text = ''.join(iter_json_columns_text(iter(rows), _dumps, fields, chunk_size=8, max_memory=max_memory))
+    assert json.loads(text) == to_columns(rows, fields)
+
+def test_async_columns_text_matches_to_columns():
+    rows = [row for row in ROWS if isinstance(row, dict)]
+
+    async def aiter_rows():
+        for row in rows:
+            yield row
+
+    async def collect():
+        return ''.join([chunk async for chunk in aiter_json_columns_text(aiter_rows(), _dumps)])
+
+    assert json.loads(asyncio.run(collect())) == to_columns(rows)
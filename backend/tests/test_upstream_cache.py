@@ -0,0 +1,201 @@
+import asyncio, threading, time
+import pytest
+from upstream_cache import SharedGeneration, UpstreamCache
+
+KEY = UpstreamCache.make_key('http://malaria/api/malaria')
+
+def test_make_key_ignores_param_order_and_none_values():
+    assert UpstreamCache.make_key('u', {'b': 2, 'a': ' 1 ', 'c': None}) == UpstreamCache.make_key('u', {'a': 1, 'b': '2'})
+
+def test_hit_after_miss():
+    cache = UpstreamCache(max_bytes=100)
+    calls = []
+    fetch = lambda: (calls.append(1) or 'value', 5, True)
+    assert cache.get_or_fetch(KEY, 60, fetch) == 'value'
+    assert cache.get_or_fetch(KEY, 60, fetch) == 'value'
+    assert len(calls) == 1
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+def test_uncacheable_values_are_not_stored():
+    cache = UpstreamCache(max_bytes=100)
+    cache.get_or_fetch(KEY, 60, lambda: ({'error': 'down'}, 0, False))
+    assert cache.peek(KEY) is None
+
+def test_expired_entries_are_refetched(monkeypatch):
+    cache = UpstreamCache(max_bytes=100)
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache.get_or_fetch(KEY, 60, lambda: ('old', 1, True))
+    now[0] += 61
+    assert cache.get_or_fetch(KEY, 60, lambda: ('new', 1, True)) == 'new'
+
+def test_lru_eviction_keeps_total_size_under_max_bytes():
+    cache = UpstreamCache(max_bytes=10)
+    keys = [UpstreamCache.make_key(f'u{i}') for i in range(3)]
+    cache.get_or_fetch(keys[0], 60, lambda: ('a', 4, True))
+    cache.get_or_fetch(keys[1], 60, lambda: ('b', 4, True))
+    cache.peek(keys[0])                                      # keys[1] is now least recently used
+    cache.get_or_fetch(keys[2], 60, lambda: ('c', 4, True))
+    assert cache.peek(keys[1]) is None
+    assert cache.peek(keys[0]) == 'a' and cache.peek(keys[2]) == 'c'
+    assert cache.stats()['bytes'] == 8
+
+def test_values_larger_than_the_cache_are_not_stored():
+    cache = UpstreamCache(max_bytes=10)
+    assert cache.get_or_fetch(KEY, 60, lambda: ('huge', 11, True)) == 'huge'
+    assert cache.peek(KEY) is None and cache.stats()['bytes'] == 0
+
+def test_invalidate_by_prefix():
+    cache = UpstreamCache(max_bytes=100)
+    country_key = UpstreamCache.make_key('http://country/api/country')
+    cache.get_or_fetch(KEY, 60, lambda: ('m', 1, True))
+    cache.get_or_fetch(country_key, 60, lambda: ('c', 1, True))
+    cache.invalidate('http://malaria/')
+    assert cache.peek(KEY) is None and cache.peek(country_key) == 'c'
+
+def test_sync_single_flight():
+    cache = UpstreamCache(max_bytes=100)
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return 'value', 1, True
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_fetch(KEY, 60, fetch))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    while cache.stats()['misses'] < 8:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['value'] * 8 and len(calls) == 1
+
+def test_sync_single_flight_shares_errors():
+    cache = UpstreamCache(max_bytes=100)
+    release = threading.Event()
+
+    def fetch():
+        release.wait(5)
+        raise RuntimeError('boom')
+
+    errors = []
+
+    def call():
+        try:
+            cache.get_or_fetch(KEY, 60, fetch)
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while cache.stats()['misses'] < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 4
+    assert cache.get_or_fetch(KEY, 60, lambda: ('value', 1, True)) == 'value'
+
+def test_invalidate_during_a_fetch_drops_its_result():
+    cache = UpstreamCache(max_bytes=100)
+
+    def fetch():
+        cache.invalidate()
+        return 'stale', 1, True
+
+    assert cache.get_or_fetch(KEY, 60, fetch) == 'stale'
+    assert cache.peek(KEY) is None
+
+def test_async_single_flight():
+    cache = UpstreamCache(max_bytes=100)
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'value', 1, True
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_fetch_async(KEY, 60, fetch) for _ in range(8)))
+
+    assert asyncio.run(main()) == ['value'] * 8
+    assert len(calls) == 1 and cache.peek(KEY) == 'value'
+
+def test_async_cancelled_leader_does_not_cancel_waiters_or_the_fetch():
+    cache = UpstreamCache(max_bytes=100)
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'value', 1, True
+
+    async def main():
+        leader = asyncio.ensure_future(cache.get_or_fetch_async(KEY, 60, fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(cache.get_or_fetch_async(KEY, 60, fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await waiter
+
+    assert asyncio.run(main()) == 'value'
+    assert len(calls) == 1 and cache.peek(KEY) == 'value'
+
+def test_async_fetch_finishes_and_is_stored_when_every_caller_is_cancelled():
+    cache = UpstreamCache(max_bytes=100)
+
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return 'value', 1, True
+
+    async def main():
+        caller = asyncio.ensure_future(cache.get_or_fetch_async(KEY, 60, fetch))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    assert cache.peek(KEY) == 'value'
+
+def test_async_errors_reach_every_caller_and_are_not_stored():
+    cache = UpstreamCache(max_bytes=100)
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('boom')
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_fetch_async(KEY, 60, fetch) for _ in range(3)),
+                                    return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(main()))
+    assert cache.peek(KEY) is None
+
+def test_async_invalidate_during_a_fetch_drops_its_result():
+    cache = UpstreamCache(max_bytes=100)
+
+    async def fetch():
+        await asyncio.sleep(0)
+        cache.invalidate()
+        return 'stale', 1, True
+
+    assert asyncio.run(cache.get_or_fetch_async(KEY, 60, fetch)) == 'stale'
+    assert cache.peek(KEY) is None
+
+def test_shared_generation_invalidates_other_caches(tmp_path):
+    first, second = UpstreamCache(max_bytes=100), UpstreamCache(max_bytes=100)
+    for cache in (first, second):
+        cache.watch('http://malaria/', SharedGeneration(str(tmp_path / 'malaria.gen')))
+        cache.get_or_fetch(KEY, 60, lambda: ('value', 1, True))
+
+    first.invalidate('http://malaria/')
+    assert second.peek(KEY) is None
+    second.get_or_fetch(KEY, 60, lambda: ('fresh', 1, True))
+    assert second.peek(KEY) == 'fresh'         # seen once, the same bump does not drop it again
@@ -0,0 +1,212 @@
+import asyncio, os, tempfile, threading, time
+from collections import OrderedDict
+
+class _Flight:
+    """An upstream call in progress that other callers of the same key wait on."""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+def _retrieve_exception(task):
+    # Every caller may have been cancelled, so nobody is left to read a failed fetch's error
+    if not task.cancelled():
+        task.exception()
+
+class SharedGeneration:
+    """Generation marker in a file, so an invalidation in one worker process is seen by all of them.
+
+    Each bump atomically replaces the file, so its (inode, mtime) changes and a stat() is enough
+    to notice. Only processes that share the file system see it, i.e. the workers of one container.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def token(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def bump(self):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(time.time()))
+        os.replace(tmp_path, self.path)
+
+class UpstreamCache:
+    """Per-worker LRU cache of upstream responses with TTLs and single-flight misses.
+
+    Entries are keyed by URL and normalized query params, and the total size of the
+    cached bodies is kept under max_bytes by evicting the least recently used entry.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (expires_at, size, value)
+        self._size = 0
+        # Waiting on a sync flight would block an event loop, and an asyncio future belongs to one
+        # loop, so sync and async callers single-flight separately: the snapshot thread and an ASGI
+        # request can fetch the same key at the same time, and the later result is stored.
+        self._in_flight = {}
+        self._async_in_flight = {}      # same as _in_flight, for callers on the event loop
+        self._generation = 0            # bumped on invalidate, so stale in-flight results are not stored
+        self._signals = {}              # url_prefix -> (SharedGeneration, last token seen)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(url, params=None):
+        # requests drops None params, so they must not split the key either
+        items = sorted((str(k), str(v).strip()) for k, v in (params or {}).items() if v is not None)
+        return (url, tuple(items))
+
+    def get_or_fetch(self, key, ttl, fetch):
+        """Return the cached value for key, or call fetch() once for all concurrent misses.
+
+        fetch() must return (value, size, cacheable); only cacheable values are stored.
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+
+            self.misses += 1
+            flight = self._in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._in_flight[key] = _Flight(self._generation)
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value, size, cacheable = fetch()
+            flight.value = value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if flight.error is None and cacheable and flight.generation == self._generation:
+                    self._store(key, ttl, size, value)
+            flight.done.set()
+
+        return value
+
+    async def get_or_fetch_async(self, key, ttl, fetch):
+        """Async version of get_or_fetch, where fetch() is a coroutine function.
+
+        The fetch runs in its own task that every caller, the first one included, awaits through
+        a shield. So waiters never block the event loop, and a cancelled caller (a client that
+        went away) neither cancels the fetch nor the other callers waiting on it.
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+
+            self.misses += 1
+            task = self._async_in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._fetch_async(key, ttl, fetch, self._generation))
+                task.add_done_callback(_retrieve_exception)
+                self._async_in_flight[key] = task
+
+        return await asyncio.shield(task)
+
+    async def _fetch_async(self, key, ttl, fetch, generation):
+        try:
+            value, size, cacheable = await fetch()
+        except BaseException:
+            with self._lock:
+                del self._async_in_flight[key]
+            raise
+
+        with self._lock:
+            del self._async_in_flight[key]
+            if cacheable and generation == self._generation:
+                self._store(key, ttl, size, value)
+        return value
+
+    def peek(self, key):
+        """Return the cached value for key, or None, without fetching on a miss."""
+        with self._lock:
+            return self._lookup(key)[1]
+
+    def watch(self, url_prefix, signal):
+        """Share invalidations of url_prefix with other processes through signal."""
+        with self._lock:
+            self._signals[url_prefix] = (signal, signal.token())
+
+    def invalidate(self, url_prefix=''):
+        """Drop every entry whose URL starts with url_prefix (all entries by default).
+
+        Other processes watching the same prefix drop theirs on their next lookup.
+        """
+        with self._lock:
+            self._invalidate(url_prefix)
+            for prefix, (signal, _) in self._signals.items():
+                if prefix.startswith(url_prefix) or url_prefix.startswith(prefix):
+                    signal.bump()
+                    self._signals[prefix] = (signal, signal.token())
+
+    def _invalidate(self, url_prefix):
+        # Caller holds the lock
+        self._generation += 1
+        for key in [key for key in self._entries if key[0].startswith(url_prefix)]:
+            self._discard(key)
+
+    def _check_signals(self):
+        # Caller holds the lock
+        for prefix, (signal, seen) in self._signals.items():
+            token = signal.token()
+            if token != seen:
+                self._signals[prefix] = (signal, token)
+                self._invalidate(prefix)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def _lookup(self, key):
+        # Caller holds the lock
+        self._check_signals()
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] <= time.monotonic():
+            self._discard(key)
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[2]
+
+    def _store(self, key, ttl, size, value):
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._discard(key)
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self._size += size
+        while self._size > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
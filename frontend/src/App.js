@@ -19,7 +19,7 @@ class App extends Component {
 
   fetchCountries = async () => {
     const { data } = await axios.get(
-      `${process.env.REACT_APP_API_URL}/malaria/filter?per_page=200`
+      `${process.env.REACT_APP_API_URL}/malaria/filter?per_page=200&fields=latlng,region,population,cases_median`
     );
     this.setState({countries: data.malaria_data});
     console.log(data.malaria_data);